@@ -1,22 +1,84 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import os
+import re
 import sys
+import sqlite3
+import threading
+from typing import Callable, TypeVar
 from pathlib import Path
+from functools import cache, partial
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import click
 
 from . import __version__
-from .audio import AudioFile, UnsupportedSuffix, CLASS_MAPPING, format_lyrics
+from .audio import AudioFile, UnsupportedSuffix, SUPPORTED_SUFFIXES, SYNCED_EXPR, format_line
+from .cache import ResponseCache
 from .controller import LRCLib
 
 # Initialization
 GREEN_FMT = "\033[32m{}\033[0m"
+LYRICS_SUFFIXES = frozenset({".txt", ".lrc"})
+
+T = TypeVar("T")
+
+# Matches the start of any non-blank line that doesn't open with a bracket
+UNSYNCED_EXPR = re.compile(r"^(?!\[|\s*$)", re.MULTILINE)
+OFFSET_EXPR = re.compile(r"(?:(\d+(?:\.\d+)?)m)?(?:(\d+(?:\.\d+)?)s)?")
 
 def t(text: str) -> str:
     return f"{text}{' ' * (13 - len(text))}: "
 
-lrclib = LRCLib()
+PROMPTS: dict[str, str] = {
+    text: t(text)
+    for text in ("LRC Status", "Track title", "Artist", "Album", "Duration")
+}
+
+@cache
+def lrclib() -> LRCLib:
+    return LRCLib()
+
+def read_lyrics(file: Path | str) -> str:
+    with open(file, "rb") as handle:
+        lyrics = handle.read().decode("utf-8")
+
+    if "\r" in lyrics:
+        lyrics = lyrics.replace("\r\n", "\n").replace("\r", "\n")
+
+    return lyrics
+
+def walk_audio(root: Path) -> list[str]:
+    files, stack = [], [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+
+                    elif os.path.splitext(entry.name)[1].lower() in SUPPORTED_SUFFIXES and entry.is_file():
+                        files.append((entry.inode(), entry.path))
+
+        except OSError:
+            continue  # Skip folders we can't read, like rglob() did
+
+    # Visiting files in inode order keeps tag reads closer to sequential on disk
+    return [path for _, path in sorted(files)]
+
+def run_in_background(function: Callable[[], T]) -> Future[T]:
+    future = Future()
+    def runner() -> None:
+        try:
+            future.set_result(function())
+
+        except Exception as e:
+            future.set_exception(e)
+
+    # Daemon thread so that backing out of a prompt doesn't wait on it
+    threading.Thread(target = runner, daemon = True).start()
+    return future
 
 # Input helpers
 def update_previous(value: str, prompt: str) -> None:
@@ -38,16 +100,22 @@ def lrcup() -> None:
     pass
 
 def process_lyrics(lyrics: str) -> tuple[str, str | None]:
-    if all([line.startswith("[") for line in lyrics.split("\n") if line.strip()]):
-        return "\n".join(
-            [
-                line.split("]")[1].lstrip()
-                for line in lyrics.split("\n")
-                if line.strip()
-            ]
-        ), format_lyrics(lyrics)
+    if UNSYNCED_EXPR.search(lyrics) is not None:
+        return lyrics, None
+
+    # Build the plain and synced versions in the same walk over the lines,
+    # splitting only on "\n" since that's all the expressions treat as a line break
+    plain_lyrics, synced_lyrics = [], []
+    for line in lyrics.split("\n"):
+        if not line.strip():
+            continue
+
+        plain_lyrics.append(line.partition("]")[2].lstrip())
+        match = SYNCED_EXPR.match(line)
+        if match is not None:
+            synced_lyrics.append(format_line(match))
 
-    return lyrics, None
+    return "\n".join(plain_lyrics), "\n".join(synced_lyrics)
 
 @lrcup.command(help = "Upload lyrics to LRCLIB from local file")
 @click.argument("file", type = click.Path(exists = True, dir_okay = False, path_type = Path))
@@ -55,26 +123,29 @@ def upload(file: Path) -> None:
     metadata = None
 
     # Load lyrics format
-    if file.suffix in [".txt", ".lrc"]:
-        plain_lyrics, synced_lyrics = process_lyrics(file.read_text(encoding = "utf-8"))
+    if file.suffix.lower() in LYRICS_SUFFIXES:
+        plain_lyrics, synced_lyrics = process_lyrics(read_lyrics(file))
         if synced_lyrics:
-            print(t("LRC Status"), "\033[32msynced\033[0m", sep = "")
+            print(PROMPTS["LRC Status"], "\033[32msynced\033[0m", sep = "")
 
         else:
-            print(t("LRC Status"), "\033[31munsynced\033[0m", sep = "")
+            print(PROMPTS["LRC Status"], "\033[31munsynced\033[0m", sep = "")
 
     else:
         try:
             metadata = AudioFile(file)
             lyrics = metadata.get_lyrics()
             if not lyrics:
-                return print(t("LRC Status"), "\033[31mmissing\033[0m", sep = "")
+                return print(PROMPTS["LRC Status"], "\033[31mmissing\033[0m", sep = "")
 
             plain_lyrics, synced_lyrics = process_lyrics(lyrics)
 
         except UnsupportedSuffix as e:
             return click.secho(e, fg = "red")
 
+    # Solve the publish challenge while the user fills in the prompts
+    challenge = run_in_background(lrclib().request_challenge)
+
     # Ask every question known to man
     payload = {}
     for field, readable in [("TITLE", "Track title"), ("ARTIST", "Artist"), ("ALBUM", ("Album", "({TITLE}) "))]:
@@ -84,17 +155,17 @@ def upload(file: Path) -> None:
 
         payload[field] = metadata and metadata.get_tag(field)
         if not payload[field]:  # Catch empty fields as well
-            payload[field] = custom_input(t(readable) + addition.format(**payload), GREEN_FMT)
+            payload[field] = custom_input(PROMPTS[readable] + addition.format(**payload), GREEN_FMT)
             if field == "ALBUM":
                 payload[field] = payload[field] or payload["TITLE"]
-                update_previous(GREEN_FMT.format(payload[field]), t(readable))
+                update_previous(GREEN_FMT.format(payload[field]), PROMPTS[readable])
 
         else:
-            print(t(readable), GREEN_FMT.format(payload[field]), sep = "")
+            print(PROMPTS[readable], GREEN_FMT.format(payload[field]), sep = "")
 
     # Take care of duration
     if metadata is None:
-        duration = custom_input(t("Duration") + "(M:S or S) ", GREEN_FMT)
+        duration = custom_input(PROMPTS["Duration"] + "(M:S or S) ", GREEN_FMT)
         if ":" in duration:
             duration = duration.split(":")
             duration = (int(duration[0]) * 60) + int(duration[1])
@@ -102,7 +173,7 @@ def upload(file: Path) -> None:
         else:
             duration = int(duration)
 
-        update_previous(GREEN_FMT.format(f"{duration} second(s)"), t("Duration"))
+        update_previous(GREEN_FMT.format(f"{duration} second(s)"), PROMPTS["Duration"])
 
     else:
         duration = metadata.length
@@ -112,9 +183,11 @@ def upload(file: Path) -> None:
         if input("\nConfirm upload (y/N)? ") not in ["y", "yes"]:
             return
 
-    # Upload to LRCLIB
-    success = lrclib.publish(
-        lrclib.request_challenge(),
+    # Upload to LRCLIB, the prefetched token is reused unless the prompts took
+    # long enough for it to expire, in which case a fresh one is solved
+    challenge.result()
+    success = lrclib().publish(
+        lrclib().request_challenge(),
         payload["TITLE"],
         payload["ARTIST"],
         payload["ALBUM"],
@@ -131,14 +204,18 @@ def upload(file: Path) -> None:
 @click.argument("lrc", type = click.Path(exists = True, dir_okay = False, path_type = Path))
 @click.argument("destination", type = click.Path(exists = True, dir_okay = False, path_type = Path))
 def embed(lrc: Path, destination: Path) -> None:
-    lyrics = lrc.read_text(encoding = "utf-8")
-    AudioFile(destination).set_lyrics("synced" if "[" in lyrics else "unsynced", lyrics)
+    lyrics = read_lyrics(lrc)
+    try:
+        AudioFile(destination).set_lyrics("synced" if "[" in lyrics else "unsynced", lyrics)
+
+    except ValueError as e:
+        click.secho(e, fg = "red")
 
 @lrcup.command(help = "Search for specific lyrics by query")
 @click.argument("query", nargs = -1, required = True)
 def search(query: str) -> None:
     results = []
-    for item in lrclib.search(" ".join(query)):
+    for item in lrclib().search(" ".join(query)):
         if not (item.plainLyrics or item.syncedLyrics):
             continue  # Ignore instrumentals
 
@@ -171,100 +248,143 @@ def search(query: str) -> None:
 def version() -> None:
     click.echo(f"LRCUP v{__version__} (https://github.com/iiPythonx/lrcup)")
 
+def autosearch_file(
+    file: str,
+    client: LRCLib,
+    force: bool,
+    embed: bool,
+    download: bool,
+    cache: ResponseCache | None
+) -> list[tuple[str, str | None]]:
+    messages = []
+    lrcfile = os.path.splitext(file)[0] + ".lrc"
+    file_name, lrcfile_name = os.path.basename(file), os.path.basename(lrcfile)
+
+    # A sidecar is all we need when not embedding, so skip parsing the tags
+    has_lrcfile = os.path.isfile(lrcfile)
+    if download and has_lrcfile and not (force or embed):
+        messages.append((f"[/] Skipping '{file_name}', lyrics already exist.", "yellow"))
+        return messages
+
+    try:
+        data = AudioFile(file)
+        snapshot = data.snapshot()
+        artist, album, title = (
+            snapshot["ALBUMARTIST"] or snapshot["ARTIST"],
+            snapshot["ALBUM"],
+            snapshot["TITLE"],
+        )
+
+        # Check if we already have lyrics from somwhere
+        has_embedded = snapshot["LYRICS"]
+
+        # I would use all() here but Ruff won't stop complaining
+        if not (artist and album and title):
+            messages.append((f"[/] Skipping {file} due to missing tags.", "yellow"))
+            return messages
+
+        synced, lyrics = False, None
+        if not force:
+            if download and has_embedded and not has_lrcfile:
+                messages.append((f"[/] Extracting {title} on {album} by {artist} from '{file_name}' to '{lrcfile_name}'", None))
+                lyrics = has_embedded
+
+            elif embed and not has_embedded and has_lrcfile:
+                messages.append((f"[/] Embedding lyrics to '{file_name}' {title} on {album} by {artist} from '{lrcfile_name}'", None))
+                lyrics = read_lyrics(lrcfile)
+
+            if lyrics:
+                plain_lyrics, synced_lyrics = process_lyrics(lyrics)
+                synced, lyrics = synced_lyrics is not None, synced_lyrics or plain_lyrics
+
+            # Skip file if we have what we want
+            if (not embed or has_embedded) and (not download or has_lrcfile):
+                messages.append((f"[/] Skipping {title} on {album} by {artist}, lyrics already exist.", "yellow"))
+                return messages
+
+        # Perform lyrics search
+        if not lyrics:
+            if embed and download:
+                messages.append((f"[/] Fetching .lrc '{lrcfile_name}' and embedding lyrics to '{file_name}' for {title} on {album} by {artist}", None))
+
+            elif embed:
+                messages.append((f"[/] Embedding lyrics to '{file_name}' for {title} on {album} by {artist}", None))
+
+            else:
+                messages.append((f"[/] Fetching .lrc '{lrcfile_name}' for {title} on {album} by {artist}", None))
+
+            if cache is not None:
+                result = cache.get(client, title, artist, album, round(snapshot["LENGTH"]))
+
+            else:
+                result = client.get(title, artist, album, round(snapshot["LENGTH"]))
+
+            if result is None:
+                messages.append((f"[-] No results found for {title} on {album} by {artist}", "red"))
+                return messages
+
+            lyrics = result.syncedLyrics or result.plainLyrics or ""
+            if not lyrics.strip():
+                messages.append((f"[-] No results found for {title} on {album} by {artist}", "red"))
+                return messages
+
+        if embed and (not has_embedded or force):
+            data.set_lyrics("synced" if synced else "unsynced", lyrics)
+
+        if download and (not has_lrcfile or force):
+            with open(lrcfile, "w", encoding = "utf-8") as handle:
+                handle.write(lyrics)
+
+        success_msg = f"[+] Fetched lyrics for {title} on {album} by {artist}. "
+        if embed and download:
+            success_msg += f"Embedded lyrics to '{file_name}' and wrote .lrc file '{lrcfile_name}'"
+
+        elif embed:
+            success_msg += f"Embedded lryics to '{file_name}'"
+
+        else:
+            success_msg += f"Wrote lyrics to .lrc file '{lrcfile_name}'"
+
+        messages.append((success_msg, "green"))
+
+    except Exception:
+        messages.append((f"[-] Failed to read tags from file '{file}'", "red"))
+
+    return messages
+
 @lrcup.command(help = "Automatically search and download lyrics for a folder")
 @click.argument("target", type = click.Path(exists = True, file_okay = False, path_type = Path))
 @click.option("--force", is_flag = True, show_default = True, default = False, help = "Force searching for lyrics")
 @click.option("--embed", is_flag = True, show_default = True, default = False, help = "Do not save the downloaded lyrics to a separate file, embed them into the music file")
 @click.option("--download", is_flag = True, show_default = True, default = True, help = "Force download lrc file even with embed on")
-def autosearch(target: Path, force: bool, embed: bool, download: bool) -> None:
-    for file in target.rglob("*"):
-        if not (file.is_file() and file.suffix in CLASS_MAPPING):
-            continue
-
-        lrcfile = file.with_suffix(".lrc")
+@click.option("--no-cache", is_flag = True, show_default = True, default = False, help = "Do not use or update the local LRCLIB response cache")
+@click.option("--workers", type = click.IntRange(1, 32), show_default = True, default = 8, help = "Number of files to process concurrently")
+def autosearch(target: Path, force: bool, embed: bool, download: bool, no_cache: bool, workers: int) -> None:
+    cache = None
+    if not no_cache:
         try:
-            data = AudioFile(file)
-            artist, album, title = (
-                data.get_tag("ALBUMARTIST") or data.get_tag("ARTIST"),
-                data.get_tag("ALBUM"),
-                data.get_tag("TITLE"),
-            )
-
-            # Check if we already have lyrics from somwhere
-            has_embedded = data.get_lyrics()
-            has_lrcfile = lrcfile.is_file()
-
-            # I would use all() here but Ruff won't stop complaining
-            if not (artist and album and title):
-                click.secho(f"[/] Skipping {file} due to missing tags.", fg = "yellow")
-                continue
-
-            synced, lyrics = False, None
-            if not force:
-                if download and has_embedded and not has_lrcfile:
-                    click.secho(f"[/] Extracting {title} on {album} by {artist} from '{file.name}' to '{lrcfile.name}'")
-                    lyrics = data.get_lyrics()
-
-                elif embed and not has_embedded and has_lrcfile:
-                    click.secho(f"[/] Embedding lyrics to '{file.name}' {title} on {album} by {artist} from '{lrcfile.name}'")
-                    lyrics = lrcfile.read_text(encoding = "utf-8")
-
-                if lyrics:
-                    plain_lyrics, synced_lyrics = process_lyrics(lyrics)
-                    synced, lyrics = synced_lyrics is not None, synced_lyrics or plain_lyrics
-
-                # Skip file if we have what we want
-                if (not embed or has_embedded) and (not download or has_lrcfile):
-                    click.secho(f"[/] Skipping {title} on {album} by {artist}, lyrics already exist.", fg = "yellow")
-                    continue
-
-            # Perform lyrics search
-            if not lyrics:
-                if embed and download:
-                    click.echo(f"[/] Fetching .lrc '{lrcfile.name}' and embedding lyrics to '{file.name}' for {title} on {album} by {artist}")
-
-                elif embed:
-                    click.echo(f"[/] Embedding lyrics to '{file.name}' for {title} on {album} by {artist}")
-
-                else:
-                    click.echo(f"[/] Fetching .lrc '{lrcfile.name}' for {title} on {album} by {artist}")
-
-                result = lrclib.get(title, artist, album, round(data.length))
-                if result is None:
-                    click.secho(
-                        f"[-] No results found for {title} on {album} by {artist}",
-                        fg = "red"
-                    )
-                    continue
-
-                lyrics = result.syncedLyrics or result.plainLyrics or ""
-                if not lyrics.strip():
-                    click.secho(
-                        f"[-] No results found for {title} on {album} by {artist}",
-                        fg = "red"
-                    )
-                    continue
-
-            if embed and (not has_embedded or force):
-                data.set_lyrics("synced" if synced else "unsynced", lyrics)
-
-            if download and (not has_lrcfile or force):
-                lrcfile.write_text(lyrics, encoding = "utf-8")
-
-            success_msg = f"[+] Fetched lyrics for {title} on {album} by {artist}. "
-            if embed and download:
-                success_msg += f"Embedded lyrics to '{file.name}' and wrote .lrc file '{lrcfile.name}'"
+            cache = ResponseCache()
 
-            elif embed:
-                success_msg += f"Embedded lryics to '{file.name}'"
+        except (OSError, sqlite3.Error) as e:
+            click.secho(f"[/] Response cache unavailable, continuing without it: {e}", fg = "yellow")
 
-            else:
-                success_msg += f"Wrote lyrics to .lrc file '{lrcfile.name}'"
+    # Resolve the client here so the workers share one session and cache,
+    # instead of racing to build their own on first use
+    client = lrclib()
 
-            click.secho(success_msg, fg = "green")
+    # Each file is handled on a worker thread so that tag parsing and LRCLIB
+    # round-trips overlap; output is printed here in walk order
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            for messages in pool.map(partial(autosearch_file, client = client, force = force, embed = embed, download = download, cache = cache), walk_audio(target)):
+                click.echo("\n".join(
+                    click.style(message, fg = color) if color else message
+                    for message, color in messages
+                ))
 
-        except Exception:
-            click.secho(f"[-] Failed to read tags from file '{file}'", fg = "red")
+    finally:
+        if cache is not None:
+            cache.close()
 
 @lrcup.command(
     help = "Apply a time offset to a specified LRC file or audio file.",
@@ -275,22 +395,15 @@ def autosearch(target: Path, force: bool, embed: bool, download: bool) -> None:
 def offset(target: Path, offset: str) -> None:
 
     # Check offset
-    offset_direction = offset[0]
+    offset_direction = offset[:1]
     if offset_direction not in ["+", "-"]:
         return click.secho("Invalid offset specified, must start with + or -.", fg = "red")
 
-    offset, offset_parts = offset[1:], {}
-    for timeframe in ["minutes", "seconds"]:
-        try:
-            split_items = offset.split(timeframe[0])
-            if len(split_items) == 1:
-                offset_parts[timeframe] = 0
-                continue
-
-            offset_parts[timeframe], offset = float(split_items[0]), split_items[1]
+    offset_match = OFFSET_EXPR.fullmatch(offset[1:])
+    if offset_match is None or not offset_match.group(0):
+        return click.secho("Invalid offset specified, expected minutes and/or seconds (eg. 1m30s, 2.5s).", fg = "red")
 
-        except ValueError:
-            return click.secho(f"Invalid offset specified, failed to convert {timeframe} to a float.", fg = "red")
+    offset_minutes, offset_seconds = float(offset_match.group(1) or 0), float(offset_match.group(2) or 0)
 
     # Load file content
     try:
@@ -303,26 +416,31 @@ def offset(target: Path, offset: str) -> None:
             return click.secho("Specified file has unsynced lyrics, not synced lyrics.", fg = "red")
 
     except UnsupportedSuffix:
-        file, lyrics = target, target.read_text(encoding = "utf-8")
+        file, lyrics = target, read_lyrics(target)
 
-    lyrics = [
-        [time, lyric]
-        for lyric, time in AudioFile.parse_lyrics(lyrics)
-    ]
+    # Parse line by line so untimed ones (eg. [ar:] metadata) can be kept as-is
+    lines = lyrics.split("\n")
+    parsed = [AudioFile.parse_lyrics(line) for line in lines]
+    times = [time for line in parsed for _, time in line]
+    if not times:
+        return click.secho("Specified file has no synced lyrics.", fg = "red")
 
     # Perform offset
-    offset_int = (offset_parts["minutes"] * 60000) + (offset_parts["seconds"] * 1000) * (1 if offset_direction == "+" else -1)
-    if lyrics[0][0] + offset_int < 0:
+    offset_int = int(((offset_minutes * 60000) + (offset_seconds * 1000)) * (1 if offset_direction == "+" else -1))
+    if min(times) + offset_int < 0:
         return click.secho("Specified offset makes lyrics go out of range.", fg = "red")
 
-    lyrics = [(lyric, int(time + offset_int)) for time, lyric in lyrics]
+    lyrics = "\n".join(
+        AudioFile.dump_lyrics([(lyric, time + offset_int) for lyric, time in line]) if line else original
+        for original, line in zip(lines, parsed)
+    )
 
     # Reconstruct lyrics
     if isinstance(file, AudioFile):
-        file.set_lyrics("synced", file.dump_lyrics(lyrics))
+        file.set_lyrics("synced", lyrics)
 
     else:
-        file.write_text(AudioFile.dump_lyrics(lyrics))
+        file.write_text(lyrics)
 
     click.secho("Applied offset successfully.", fg = "green")
 
@@ -1,32 +1,31 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import os
 import re
-import math
 from pathlib import Path
+from functools import cache
+from importlib import import_module
 from typing import Literal
 
-from mutagen.mp3 import MP3
-from mutagen.flac import FLAC
-from mutagen.mp4 import MP4
-from mutagen.id3._frames import USLT, SYLT
-
 # Initialization
+# Mutagen is only imported once a file of that type is actually opened
 CLASS_MAPPING = {
-    ".mp3": MP3,
-    ".flac": FLAC,
-    ".m4a": MP4
+    ".mp3": "mutagen.mp3:MP3",
+    ".flac": "mutagen.flac:FLAC",
+    ".m4a": "mutagen.mp4:MP4"
 }
+SUPPORTED_SUFFIXES = frozenset(CLASS_MAPPING)
 
 # Tag Mapping based on FileType
 TAG_MAPPING = {
-    MP3: {
+    "MP3": {
         "TITLE": "TIT2",
         "ALBUM": "TALB",
         "ARTIST": "TPE1",
         "ALBUMARTIST": "TPE2"
     },
-    MP4: { # reference: https://mutagen.readthedocs.io/en/latest/api/mp4.html#mutagen.mp4.MP4Tags
+    "MP4": { # reference: https://mutagen.readthedocs.io/en/latest/api/mp4.html#mutagen.mp4.MP4Tags
         "TITLE": "\xa9nam",
         "ALBUM": "\xa9alb",
         "ARTIST": "\xa9ART",
@@ -34,21 +33,35 @@ TAG_MAPPING = {
     },
 }
 
+# Formats that store lyrics as a plain tag rather than ID3 frames
+LYRICS_MAPPING = {
+    "FLAC": "LYRICS",
+    "MP4": "\xa9lyr"
+}
+
 # Regular expressions
-SYNCED_EXPR = re.compile(r"\[(\d{2}:\d{2}.\d{2})\](.*)")
+SYNCED_EXPR = re.compile(r"^\[(\d{2}:\d{2}\.\d{2})\](.*)", re.MULTILINE)
 
 # Exceptions
 class UnsupportedSuffix(ValueError):
     pass
 
+@cache
+def load_type(suffix: str) -> type:
+    module, name = CLASS_MAPPING[suffix].split(":")
+    return getattr(import_module(module), name)
+
 # Audio handler
 class AudioFile():
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path | str) -> None:
         self.path = path
-        if path.suffix not in CLASS_MAPPING:
-            raise UnsupportedSuffix(f"Unsupported file extension: '{path.suffix}'!")
+        self.suffix = os.path.splitext(path)[1].lower()
+        if self.suffix not in SUPPORTED_SUFFIXES:
+            raise UnsupportedSuffix(f"Unsupported file extension: '{self.suffix}'!")
 
-        self.type = CLASS_MAPPING[path.suffix]
+        self.type = load_type(self.suffix)
+        self.tag_mapping = TAG_MAPPING.get(self.type.__name__, {})
+        self.lyrics_tag = LYRICS_MAPPING.get(self.type.__name__)
         self.file = self.type(path)
         self.length = self.file.info.length
 
@@ -58,44 +71,57 @@ class AudioFile():
     @staticmethod
     def parse_lyrics(lyrics: str) -> list[tuple[str, int]]:
         new_lyrics = []
-        for line in lyrics.split("\n"):
-            if not line.strip():
-                continue
 
-            time, text = re.findall(SYNCED_EXPR, line)[0]
-            new_lyrics.append((text.strip(), int((60000 * int(time[:2])) + (1000 * float(time[3:])))))
+        # Untimed lines (blanks, metadata tags like [ar:...]) simply don't match
+        for match in SYNCED_EXPR.finditer(lyrics):
+            time, text = match.groups()
+            new_lyrics.append((text.strip(), (60000 * int(time[:2])) + (1000 * int(time[3:5])) + (10 * int(time[6:]))))
 
         return new_lyrics
 
     @staticmethod
     def dump_lyrics(lyrics: list[tuple[str, int]]) -> str:
         converted = []
+        append = converted.append
         for text, time in lyrics:
-            minutes = math.floor(time / 60000)
-            seconds = math.floor((time / 1000) - (minutes * 60))
-            millisc = time - (minutes * 60000) - (seconds * 1000)
-            converted.append(f"[{str(minutes).zfill(2)}:{str(seconds).zfill(2)}.{str(millisc).rstrip('0').ljust(2, '0')}] {text}")
+            minutes, millisc = divmod(time, 60000)
+            seconds, millisc = divmod(millisc, 1000)
+            append("[%02d:%02d.%02d] %s" % (minutes, seconds, millisc // 10, text))
 
         return "\n".join(converted)
 
     def get_tag(self, tag: str, as_string: bool = True) -> str | None:
-        if self.type in TAG_MAPPING:
-            tag = TAG_MAPPING[self.type].get(tag, tag)
+        tag = self.tag_mapping.get(tag, tag)
 
         if tag in self.file:
             field = self.file[tag]
             return field[0] if isinstance(field, list) else (str(field) if as_string else field)
 
-    def set_tag(self, tag: str, value: str) -> None:
-        if self.type in TAG_MAPPING:
-            tag = TAG_MAPPING[self.type].get(tag, tag)
+    def set_tag(self, tag: str, value: str, *, save: bool = True) -> None:
+        tag = self.tag_mapping.get(tag, tag)
 
         self.file[tag] = value
+        if save:
+            self.save()
+
+    def save(self) -> None:
         self.file.save()
 
+    def snapshot(self) -> dict[str, str | float | None]:
+        return {
+            "TITLE": self.get_tag("TITLE"),
+            "ALBUM": self.get_tag("ALBUM"),
+            "ARTIST": self.get_tag("ARTIST"),
+            "ALBUMARTIST": self.get_tag("ALBUMARTIST"),
+            "LYRICS": self.get_lyrics(),
+            "LENGTH": self.length
+        }
+
     def get_lyrics(self, language: str | None = None) -> str | None:
-        if self.type in [FLAC, MP4]:
-            return self.get_tag("LYRICS" if self.type == FLAC else "\xa9lyr")
+        if self.lyrics_tag is not None:
+            return self.get_tag(self.lyrics_tag)
+
+        from mutagen.id3._frames import SYLT
 
         lyrics = None
         if language is not None:
@@ -105,11 +131,10 @@ class AudioFile():
 
             # Cycle until we find ANY lyrics since we didn't specify
             # a language to look for
-            lyrics = [
+            lyrics = next((
                 value for tag, value in self.file.items()
-                if tag[:4] in ["USLT", "SYLT"]
-            ]
-            lyrics = lyrics[0] if lyrics else None
+                if tag.startswith(("USLT", "SYLT"))
+            ), None)
     
         if isinstance(lyrics, SYLT):
             lyrics = self.dump_lyrics(lyrics.text)  # type: ignore
@@ -117,14 +142,24 @@ class AudioFile():
         return str(lyrics) if lyrics else None
 
     def set_lyrics(self, state: Literal["synced", "unsynced"], lyrics: str | list, language: str = "XXX") -> None:
-        if self.type in [FLAC, MP4]:
+        parsed = None
+        if state == "synced" and isinstance(lyrics, str):
+            parsed = self.parse_lyrics(lyrics)
+
+            # Refuse rather than overwrite the existing lyrics with nothing
+            if not parsed:
+                raise ValueError("Synced lyrics do not contain any timed lines!")
+
+        if self.lyrics_tag is not None:
             if isinstance(lyrics, list):
                 raise ValueError
 
-            return self.set_tag("LYRICS" if self.type == FLAC else "\xa9lyr", lyrics)
+            return self.set_tag(self.lyrics_tag, lyrics)
 
-        if state == "synced" and isinstance(lyrics, str):
-            lyrics = self.parse_lyrics(lyrics)
+        from mutagen.id3._frames import USLT, SYLT
+
+        if parsed is not None:
+            lyrics = parsed
 
         arguments = {"lang": language, "text": lyrics}
         if state == "synced":
@@ -134,7 +169,8 @@ class AudioFile():
         self.set_tag(f"{type(object).__name__}::{language}", object)
 
 # Handle lyrics formatting
+def format_line(match: re.Match[str]) -> str:
+    return f"[{match.group(1)}] {match.group(2)}"
+
 def format_lyrics(lyrics: str) -> str:
-    return "\n".join([
-        f"[{time}] {line}" for (time, line) in re.findall(SYNCED_EXPR, lyrics)
-    ])
+    return "\n".join(map(format_line, SYNCED_EXPR.finditer(lyrics)))
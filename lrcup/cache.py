@@ -0,0 +1,85 @@
+# Copyright (c) 2024 iiPython
+
+# Modules
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+from .controller import LRCLib, Track
+
+# Initialization
+FOUND_TTL = 30 * 86400
+MISSING_TTL = 86400  # Kept short so we still pick up lyrics added to LRCLIB later
+
+# Response cache
+class ResponseCache():
+    def __init__(self, path: Path | None = None) -> None:
+        if path is None:
+            path = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "lrcup" / "responses.db"
+
+        path.parent.mkdir(parents = True, exist_ok = True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, track TEXT, expires REAL)"
+                )
+
+                # Drop expired responses so the database doesn't grow forever
+                self.connection.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+
+        except sqlite3.Error:
+            pass  # eg. locked by another run, lookups will fall back to LRCLIB
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @staticmethod
+    def key(track: str, artist: str, album: str, duration: int) -> str:
+        return hashlib.blake2b(
+            f"{track}\0{artist}\0{album}\0{duration}".encode(),
+            digest_size = 16
+        ).hexdigest()
+
+    def get(
+        self,
+        lrclib: LRCLib,
+        track: str,
+        artist: str,
+        album: str,
+        duration: int
+    ) -> Track | None:
+        key = self.key(track, artist, album, duration)
+        try:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT track, expires FROM responses WHERE key = ?",
+                    (key,)
+                ).fetchone()
+
+        except sqlite3.Error:
+            row = None
+
+        if row is not None and row[1] > time.time():
+            return Track.model_validate_json(row[0]) if row[0] else None
+
+        result = lrclib.get(track, artist, album, duration)
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (
+                        key,
+                        result and result.model_dump_json(),
+                        time.time() + (FOUND_TTL if result is not None else MISSING_TTL)
+                    )
+                )
+
+        except sqlite3.Error:
+            pass  # Not being able to cache a response shouldn't fail the lookup
+
+        return result
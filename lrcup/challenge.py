@@ -2,16 +2,21 @@
 # https://github.com/Dr-Blank/lrclibapi/blob/main/lrclib/cryptographic_challenge_solver.py
 
 # Modules
+import os
 import hashlib
 import threading
+import multiprocessing
+from multiprocessing.sharedctypes import Synchronized
 
-# Solution class
-class Solution:
-    def __init__(self) -> None:
-        self.nonce: int = 0
+# Initialization
+CHECK_INTERVAL = 1024
 
-    def is_solved(self) -> bool:
-        return self.nonce != 0
+# Forking a multi-threaded process can deadlock the children (eg. `lrcup upload`
+# solves on a background thread while prompting), so those callers start their
+# workers through a forkserver instead
+THREADED_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
 
 def is_nonce_valid(prefix: str, nonce: int, target: bytes) -> bool:
     hash_value = hashlib.sha256(f"{prefix}{nonce}".encode()).digest()
@@ -20,28 +25,52 @@ def is_nonce_valid(prefix: str, nonce: int, target: bytes) -> bool:
 def find_nonce(
     prefix: str,
     target: bytes,
-    solution: Solution,
+    solution: Synchronized,
     start: int,
     step: int
-) -> Solution:
-    nonce = start
-    while not solution.is_solved():
-        if is_nonce_valid(prefix, nonce, target):
-            solution.nonce = nonce
-            break
+) -> None:
 
-        nonce += step
+    # The prefix never changes, so hash it once and resume from a copy of
+    # that state for every nonce instead of rehashing it each time
+    prefix_state, batch_start = hashlib.sha256(prefix.encode()), start
+    while solution.value < 0:
 
-    return solution
+        # Only check whether another worker has finished every so often
+        for nonce in range(batch_start, batch_start + (step * CHECK_INTERVAL), step):
+            state = prefix_state.copy()
+            state.update(str(nonce).encode())
+            if state.digest() < target:
+                with solution.get_lock():
+                    if solution.value < 0:
+                        solution.value = nonce
+
+                return
+
+        batch_start += step * CHECK_INTERVAL
 
 def solve(prefix: str, target: str) -> int:
-    target_bytes, solution, threads = bytes.fromhex(target), Solution(), []
-    for i in range(4):
-        threads.append(threading.Thread(
+    context = THREADED_CONTEXT if threading.active_count() > 1 else multiprocessing.get_context()
+    target_bytes, solution = bytes.fromhex(target), context.Value("q", -1)
+
+    # Hashing holds the GIL for most of each iteration, so use processes
+    workers = os.cpu_count() or 4
+    processes = [
+        context.Process(
             target = find_nonce,
-            args = (prefix, target_bytes, solution, i, 4),
-        ))
+            args = (prefix, target_bytes, solution, i, workers),
+            daemon = True
+        )
+        for i in range(workers)
+    ]
+
+    [p.start() for p in processes]
+    [p.join() for p in processes]
+
+    # Every worker exiting without a nonce means they crashed or were killed
+    if solution.value < 0:
+        raise RuntimeError("Failed to solve the publish challenge, all worker processes exited without a nonce.")
+
+    if not is_nonce_valid(prefix, solution.value, target_bytes):
+        raise RuntimeError(f"Failed to solve the publish challenge, nonce {solution.value} does not meet the target.")
 
-    [t.start() for t in threads]
-    [t.join() for t in threads]
-    return solution.nonce
+    return solution.value
@@ -1,14 +1,25 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import time
 import typing
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from . import __version__
 from .challenge import solve
 
+# Initialization
+# LRCLIB documents that each challenge expires 5 minutes after it is issued
+# (https://lrclib.net/docs), keep a minute spare for the publish request itself
+CHALLENGE_VALIDITY = 300
+CHALLENGE_TTL = CHALLENGE_VALIDITY - 60
+
 # Models
 class Track(BaseModel):
     id:             int
@@ -20,24 +31,41 @@ class Track(BaseModel):
     plainLyrics:    str
     syncedLyrics:   str
 
+TRACK_LIST_ADAPTER = TypeAdapter(list[Track])
+
 # API Controller
 class LRCLib():
-    def __init__(self, api_url: str = "https://lrclib.net/api/") -> None:
+    def __init__(self, api_url: str = "https://lrclib.net/api/", pool_size: int = 32) -> None:
         self.session = requests.Session()
+        self.session.headers["User-Agent"] = f"LRCUP v{__version__} (https://github.com/iiPythonx/lrcup)"
         self.api_url = f"{api_url.rstrip('/')}/"
+        self.challenge: tuple[str, float] | None = None
+
+        # Lookups are stateless, so repeated ones are answered from memory
+        self._cached_get = lru_cache(maxsize = 1024)(self._get)
+        self._cached_get_by_id = lru_cache(maxsize = 1024)(self._get_by_id)
+
+        # Keep enough pooled keep-alive connections for concurrent callers, and
+        # back off and retry when LRCLIB rate limits us or has a hiccup
+        self.session.mount(self.api_url, HTTPAdapter(
+            pool_maxsize = pool_size,
+            max_retries = Retry(
+                total = 5,
+                backoff_factor = 0.5,
+                status_forcelist = [429, 500, 502, 503, 504],
+                raise_on_status = False
+            )
+        ))
 
     def _request(self, method: str, endpoint: str, headers: dict = {}, **kwargs) -> requests.Response:
-        headers = {
-            "User-Agent": f"LRCUP v{__version__} (https://github.com/iiPythonx/lrcup)",
-            **headers
-        }
-        return getattr(self.session, method)(
+        return self.session.request(
+            method,
             self.api_url + endpoint,
             headers = headers,
             **kwargs
         )
 
-    def get(
+    def _get(
         self,
         track: str,
         artist: str,
@@ -49,18 +77,42 @@ class LRCLib():
             "artist_name": artist,
             "album_name": album,
             "duration": duration
-        }).json()
-        if response.get("code", 200) == 404:
+        })
+        if response.status_code == 404:
             return None
 
-        return Track(**response)
+        return Track.model_validate_json(response.content)
 
-    def get_by_id(self, record_id: int) -> Track | None:
-        response = self._request("get", f"get/{record_id}").json()
-        if response.get("code", 200) == 404:
+    def get(
+        self,
+        track: str,
+        artist: str,
+        album: str,
+        duration: int
+    ) -> Track | None:
+        return self._cached_get(track, artist, album, duration)
+
+    def get_many(
+        self,
+        tracks: list[tuple[str, str, str, int]],
+        workers: int = 8
+    ) -> list[Track | None]:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            return list(pool.map(lambda track: self.get(*track), tracks))
+
+    def _get_by_id(self, record_id: int) -> Track | None:
+        response = self._request("get", f"get/{record_id}")
+        if response.status_code == 404:
             return None
 
-        return Track(**response)
+        return Track.model_validate_json(response.content)
+
+    def get_by_id(self, record_id: int) -> Track | None:
+        return self._cached_get_by_id(record_id)
+
+    def clear_cache(self) -> None:
+        self._cached_get.cache_clear()
+        self._cached_get_by_id.cache_clear()
 
     def search(
         self,
@@ -72,15 +124,12 @@ class LRCLib():
         if not (query or track):
             raise ValueError("Either query or track must be specified! Please see https://lrclib.net/docs.")
 
-        return [
-            Track(**record)
-            for record in self._request("get", "search", params = {
-                "q": query,
-                "track_name": track,
-                "artist_name": artist,
-                "album_name": album
-            }).json()
-        ]
+        return TRACK_LIST_ADAPTER.validate_json(self._request("get", "search", params = {
+            "q": query,
+            "track_name": track,
+            "artist_name": artist,
+            "album_name": album
+        }).content)
 
     def publish(
         self,
@@ -92,6 +141,11 @@ class LRCLib():
         plain_lyrics: typing.Optional[str] = "",
         synced_lyrics: typing.Optional[str] = ""
     ) -> bool:
+
+        # Never hand out a token again once it has been sent to LRCLIB
+        if self.challenge is not None and self.challenge[0] == token:
+            self.challenge = None
+
         return self._request(
             "post",
             "publish",
@@ -107,5 +161,14 @@ class LRCLib():
         ).status_code == 201
 
     def request_challenge(self) -> str:
+        if self.challenge is not None and time.monotonic() - self.challenge[1] < CHALLENGE_TTL:
+            return self.challenge[0]
+
+        # The expiry counts from when LRCLIB issued the challenge, not when we solved it
+        issued = time.monotonic()
         data = self._request("post", "request-challenge").json()
-        return f"{data['prefix']}:{solve(data['prefix'], data['target'])}"
+
+        # solve() raises rather than returning a nonce that fails the target
+        token = f"{data['prefix']}:{solve(data['prefix'], data['target'])}"
+        self.challenge = (token, issued)
+        return token